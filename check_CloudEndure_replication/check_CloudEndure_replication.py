@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 # =================================================================================================
 # check_CloudEndure_replication.py
@@ -38,7 +38,7 @@
 # Outputs: One line of text containing the explanation of the replication status. Note that 
 # 	this will be one line no matter how many hosts are found (in the case of "all")
 # 
-# Exit status: 0, 1, 2, 3 as standard Nagios status codes. See EXIT_STATUS_DICT for mapping.
+# Exit status: 0, 1, 2, 3 as standard Nagios status codes. See OK / WARNING / CRITICAL / UNKNOWN for mapping.
 # 
 # =================================================================================================
 # 
@@ -75,24 +75,34 @@
 
 
 
-import httplib, json, re, sys, argparse, time, calendar
-from datetime import datetime
+import json, sys, argparse, time, calendar, os, hashlib, fcntl, threading
+from collections import defaultdict
+from http.cookies import SimpleCookie
 
-# Dictionary for exit status codes
-EXIT_STATUS_DICT = {
-	"OK": 0,
-	"WARNING": 1,
-	"CRITICAL": 2,
-	"UNKNOWN": 3
-}
+# Note: Since this runs every few minutes, start-up time matters. So some modules which are slow to
+# load, and which aren't needed on every run, only get imported where they're used:
+# http.client / socket in open_connection(), gzip in read_body(), datetime in last_sync_time_test()
+# and concurrent.futures in the "all" branch.
 
-# Dictionary for looking up the status string from the value
-EXIT_STATUS_DICT_REVERSE = {
-	0: "OK",
-	1: "WARNING",
-	2: "CRITICAL",
-	3: "UNKNOWN"
-}
+# The listMachines response gets big with a lot of hosts, and parsing it is most of our CPU time.
+# So if there's a faster JSON parser installed, use it for reading - otherwise the standard one is fine.
+# (All of them raise a ValueError for bad JSON. Output is still done with json.dumps() everywhere.)
+try:
+	from orjson import loads as json_loads
+except ImportError:
+	try:
+		from ujson import loads as json_loads
+	except ImportError:
+		json_loads = json.loads
+
+# Exit status codes
+OK, WARNING, CRITICAL, UNKNOWN = 0, 1, 2, 3
+
+# All the exit status codes from best to worst, and the status string for each one (indexed by the code)
+SEVERITIES = ( OK, WARNING, CRITICAL, UNKNOWN )
+SEVERITY_NAMES = ( "OK", "WARNING", "CRITICAL", "UNKNOWN" )
+
+NOW = int( time.time() )	# The one "now" that every host's last sync time gets measured against
 
 # To do: make these optional args
 WARNING_SYNC_DELAY  = 1800	# Number of seconds over which it's a Warning - we will forgive any sync delay up to 30 min.
@@ -100,10 +110,42 @@ CRITICAL_SYNC_DELAY = 3600	# Number of seconds (equals 1 hour) beyond which it's
 
 CLOUDENDURE_API_HOST = "api.cloudendure.com"
 
+# The ISO-8601 formats we try with datetime.strptime() when iso8601_to_epoch() can't handle a timestamp,
+# most likely first. https://en.wikipedia.org/wiki/ISO_8601
+# See format codes at https://docs.python.org/3/library/datetime.html
+ISO_8601_FORMATS = (
+	'%Y-%m-%dT%H:%M:%S.%f+00:00',
+	'%Y-%m-%dT%H:%M:%S+00:00',
+	'%Y-%m-%dT%H:%M:%S.%fZ',
+	'%Y-%m-%dT%H:%M:%SZ',
+	'%Y-%m-%dT%H:%M:%S.%f%z',
+	'%Y-%m-%dT%H:%M:%S%z',
+	'%Y%m%dT%H%M%SZ'
+)
+
+MAX_CHECK_THREADS = 16		# Upper limit on how many instances get checked at the same time in the "all" case
+PRINT_LOCK = threading.Lock()	# Only one thread at a time gets to print verbose output. See verbose_print()
+
+# Responses from these API functions get saved in a cache file and re-used by the following runs
+# for this many seconds. The location almost never changes, so we keep that for a day. (If it does
+# change, the listMachines call fails and we go and get it again.) The machine list does change - so
+# that one is only kept long enough to help when many services are checking the same account at the
+# same time. Any function not listed here is never cached.
+# 'noNameFilter' isn't an API function - it's our note that listMachines turned down the 'name'
+# filter for this account, so that we don't keep asking it to. (See the listMachines call below.)
+CACHE_TTL = {
+	'getUserDetails': 86400,
+	'listMachines':   10,
+	'noNameFilter':   86400
+}
+CACHE_FILE = "/var/tmp/cloudendure_cache_{0}.json"	# {0} gets a hash of the user name, so each account has its own
+
+LOGOUT_TIMEOUT = 0.5		# Seconds we're willing to wait for the logout. By then we already have our answer.
+
 
 
 ###################################################################################################
-def exit_with_message( message = "Something not defined", exitCode = EXIT_STATUS_DICT[ 'UNKNOWN' ] ):
+def exit_with_message( message = "Something not defined", exitCode = UNKNOWN ):
 
 # Output a message and exit
 # 
@@ -116,19 +158,24 @@ def exit_with_message( message = "Something not defined", exitCode = EXIT_STATUS
 # Note the default values.
 
 	prefix = ""
-	if exitCode == EXIT_STATUS_DICT[ 'UNKNOWN' ]: prefix = "Error: "		# Add additional info at beginning
+	if exitCode == UNKNOWN: prefix = "Error: "		# Add additional info at beginning
 
-	print "{0}{1}".format( prefix, message )
+	print( "{0}{1}".format( prefix, message ) )
 
 	# Try and do a proper logout (because they want that) but NOT if we got here because of 
 	# an 'Unknown' state! If we tried to do a 'logout' call on 'Unknown' we'd be risking an 
 	# endless loop of send_request() fail bringing us back here again. Ugly.
 	# (Nagios would eventually time out this script, but let's not even risk it.)
-	if exitCode != EXIT_STATUS_DICT[ 'UNKNOWN' ]:
+	# (If everything came out of the cache we never logged in, so there's nothing to log out of.)
+	# The logout is only a courtesy, so it gets a short timeout and it's not allowed to fail the
+	# check - a slow or broken logout must not delay or change the result we already printed.
+	if exitCode != UNKNOWN and session_cookie:
 		try:
-			response, connection = send_request( 'logout', {}, { 'Cookie': session_cookie } )	# Here we don't care what is the response.
+			connection.sock.settimeout( LOGOUT_TIMEOUT )
+			response = send_request( 'logout', {}, False )
+			response.read()		# Here we don't care what is the response.
 			connection.close()
-			if args.verbose: print "Connection closed"
+			if args.verbose: print( "Connection closed" )
 		except Exception:
 			sys.exit( exitCode )	# If we get an error trying to log out, just bail.
 
@@ -145,105 +192,446 @@ def last_sync_time_test( instance ):
 # 	'dictionary' is from JSON, containing details of one specific host
 # 
 # Returns: tuple of ( string, int ) where 'string' is a status message and 'int' is a status code
+# 
+# Note: This doesn't change the 'instance' dictionary or any other shared state, so it's safe
+# to run it for many instances at once in threads. (See the "all" branch below.)
 
-	if args.verbose: print "replicationState:", instance[ 'replicationState' ]
-	if args.verbose: print "lastConsistencyTime ISO-8601:", instance[ 'lastConsistencyTime' ]
+	# Since this runs in threads, each line of verbose output says which instance it's about.
+	verbose_print( "\nname:", instance[ 'name' ] )
+	verbose_print( instance[ 'name' ], "replicationState:", instance[ 'replicationState' ] )
+	verbose_print( instance[ 'name' ], "lastConsistencyTime ISO-8601:", instance[ 'lastConsistencyTime' ] )
 
 	# First thing to check is the text string of the state
 	if instance[ 'replicationState' ] != "Replicated":
-		message = instance[ 'name' ] + " (" + instance[ 'id' ] + ") in account \"" + args.username + "\" is \"" + instance[ 'replicationState' ] + "\" not \"Replicated\" !!"
-		return ( message, EXIT_STATUS_DICT[ 'CRITICAL' ] )
+		message = "{0} ({1}) in account \"{2}\" is \"{3}\" not \"Replicated\" !!".format( instance[ 'name' ], instance[ 'id' ], args.username, instance[ 'replicationState' ] )
+		return ( message, CRITICAL )
 
 	# Dummy check the timestamp, because if the host isn't replicating the timestamp will be null
 	# This shouldn't be a real indication of replication failure, because the 'replicationState' being
 	# checked above should catch it.
 	if instance[ 'lastConsistencyTime' ] is None:
 		message = instance[ 'name' ] + " lastConsistencyTime is empty! There should be something there if it is replicating properly!"
-		return ( message, EXIT_STATUS_DICT[ 'UNKNOWN' ] )
+		return ( message, UNKNOWN )
 
 	# Convert ISO-8601 format to UNIX epoch (integer seconds since Jan 1 1970) since that makes the math easy :-)
-	# We will try several different ISO-8601 formats before giving up.
-	# https://en.wikipedia.org/wiki/ISO_8601
-	# See format codes at https://docs.python.org/2/library/datetime.html
-	originalTimeValue = instance[ 'lastConsistencyTime' ]		# Save it for later. We will be trying to replace it with the integer value.
-	for format in ( '%Y-%m-%dT%H:%M:%S.%f%z', '%Y-%m-%dT%H:%M:%S%z', '%Y-%m-%dT%H:%M:%S.%f+00:00', '%Y-%m-%dT%H:%M:%S+00:00', '%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%M:%SZ', '%Y%m%dT%H%M%SZ' ):
-		if args.verbose: print "Trying ISO-8601 format ", format
-		try:
-			instance[ 'lastConsistencyTime' ] = calendar.timegm( datetime.strptime( instance[ 'lastConsistencyTime' ], format ).timetuple() )
-			if isinstance( instance[ 'lastConsistencyTime' ], ( int, long ) ):
+	# The usual format gets handled by the fast iso8601_to_epoch(). If that can't do it,
+	# we will try the ISO_8601_FORMATS one by one before giving up.
+	lastSyncTime = iso8601_to_epoch( instance[ 'lastConsistencyTime' ] )
+	parsed = lastSyncTime is not None
+	if not parsed:
+		from datetime import datetime
+		for format in ISO_8601_FORMATS:
+			verbose_print( instance[ 'name' ], "trying ISO-8601 format", format )
+			try:
+				# utctimetuple() (not timetuple) so a "+02:00" style offset gets taken off. A time with
+				# no offset in it is left as it is, which is right since those are all UTC ("Z").
+				lastSyncTime = calendar.timegm( datetime.strptime( instance[ 'lastConsistencyTime' ], format ).utctimetuple() )
+				parsed = True
 				break		# If we managed to get a numeric value, we're done.
-		except ValueError:
-			continue		# Try again with the next format if this one didn't work.
+			except ValueError:
+				continue		# Try again with the next format if this one didn't work.
 
-	# If we still have the same time value & format as before, we failed to find a matching ISO-8601 pattern.
-	if instance[ 'lastConsistencyTime' ] == originalTimeValue:
-		message = instance[ 'name' ] + " lastConsistencyTime " + str( instance[ 'lastConsistencyTime' ] ) + " doesn't appear to be a date / time in a recognized ISO-8601 format!"
-		return ( message, EXIT_STATUS_DICT[ 'UNKNOWN' ] )
+	# If none of them worked, we failed to find a matching ISO-8601 pattern.
+	if not parsed:
+		message = "{0} lastConsistencyTime {1} doesn't appear to be a date / time in a recognized ISO-8601 format!".format( instance[ 'name' ], instance[ 'lastConsistencyTime' ] )
+		return ( message, UNKNOWN )
 
-	# Now for the ultimate in being careful, make sure it really is an integer!
-	if not isinstance( instance[ 'lastConsistencyTime' ], ( int, long ) ):
-		message = instance[ 'name' ] + " lastConsistencyTime is not an integer!"
-		return ( message, EXIT_STATUS_DICT[ 'UNKNOWN' ] )
-	if args.verbose: print "lastConsistencyTime UNIX epoch seconds:", instance[ 'lastConsistencyTime' ]
+	verbose_print( instance[ 'name' ], "lastConsistencyTime UNIX epoch seconds:", lastSyncTime )
 
 
 	# Make a string that's human-readable for printing in output
-	lastSyncTimeStr = time.strftime( '%Y-%m-%d %H:%M:%S', time.localtime( instance[ 'lastConsistencyTime' ] ) )
+	lastSyncTimeStr = time.strftime( '%Y-%m-%d %H:%M:%S', time.localtime( lastSyncTime ) )
 
 	# Finally calculate how far back was the last sync
-	if args.verbose: print "Time now", int( time.time() )
-	timeDelta = int( time.time() ) - instance[ 'lastConsistencyTime' ]
-	if args.verbose: print "lastConsistencyTime seconds ago:", timeDelta
+	timeDelta = NOW - lastSyncTime
+	verbose_print( instance[ 'name' ], "lastConsistencyTime seconds ago:", timeDelta, "(time now", NOW, ")" )
+
+	if ( timeDelta <= WARNING_SYNC_DELAY ):		# This is the first test, because it's the usual case - if the delay since last sync is less than our tolerance for Warning, it's good!!
+		message = "{0} last update {1}, {2}".format( instance[ 'name' ], lastSyncTimeStr, seconds_to_time_text( timeDelta ) )
+		return ( message, OK )
+	elif ( timeDelta <= CRITICAL_SYNC_DELAY ):
+		message = "{0} has not had an update since {1}, {2}".format( instance[ 'name' ], lastSyncTimeStr, seconds_to_time_text( timeDelta ) )
+		return ( message, WARNING )
+	else:
+		message = "{0} has not had an update since {1}, {2}".format( instance[ 'name' ], lastSyncTimeStr, seconds_to_time_text( timeDelta ) )
+		return ( message, CRITICAL )
+
 
-	if ( timeDelta > CRITICAL_SYNC_DELAY ):		# This is the first test, because the longest delay value is Critical
-		message = instance[ 'name' ] + " has not had an update since " + lastSyncTimeStr + ", " + str( seconds_to_time_text( timeDelta ) )
-		return ( message, EXIT_STATUS_DICT[ 'CRITICAL' ] )
 
-	if ( timeDelta > WARNING_SYNC_DELAY ):
-		message = instance[ 'name' ] + " has not had an update since " + lastSyncTimeStr + ", " + str( seconds_to_time_text( timeDelta ) )
-		return ( message, EXIT_STATUS_DICT[ 'WARNING' ] )
+###################################################################################################
+def verbose_print( *items ):
 
-	if ( timeDelta <= WARNING_SYNC_DELAY ):		# If the delay since last sync is less than our tolerance for Warning, it's good!!
-		message = instance[ 'name' ] + " last update " + lastSyncTimeStr + ", " + str( seconds_to_time_text( timeDelta ) )
-		return ( message, EXIT_STATUS_DICT[ 'OK' ] )
+# Print a line of verbose output (only if we're in verbose mode) without getting it mixed up
+# with the output of any other threads.
+# 
+# Usage: verbose_print( item [, item ... ] )
+# 	'item' is anything - they get printed space-separated on one line, just like "print"
+# 
+# Returns: nothing
 
-	message = "Could not analyze the sync state for " + instance[ 'name' ]
-	return ( message, EXIT_STATUS_DICT[ 'UNKNOWN' ] )		# If we get to this point something went wrong!
+	if not args.verbose: return
+	with PRINT_LOCK:
+		print( " ".join( str( item ) for item in items ) )
 
 
 
 ###################################################################################################
-def send_request( function, params, headers ):
+def iso8601_to_epoch( timeString ):
 
-# This function makes the HTTPS call out to the CloudEndure API and makes sure we get a '200' HTTP status
-# before returning the JSON
+# This function is a fast way of converting the usual CloudEndure timestamp to UNIX epoch seconds.
 # 
-# Usage: send_request( string, dict1, dict2 )
+# Usage: iso8601_to_epoch( string )
+# 	'string' is an ISO-8601 UTC date / time in the extended format, with or without fractional
+# 	seconds, ending in "Z" or "+00:00" - such as "2016-01-01T22:08:15.803212+00:00"
+# 
+# Returns: int of the seconds since Jan 1 1970, or None if 'string' isn't laid out like that.
+# 	(None means the caller should fall back to trying the other formats with datetime.strptime() )
+# 
+# Note: datetime.strptime() is slow because it has to work through the format string on every
+# call. Since every field is fixed-width we can just slice them out. Fractional seconds are ignored,
+# the same as strptime() + utctimetuple() would do.
+# 
+# Note: Anything this can't be sure of gets None, so that strptime() decides. Only ASCII digits
+# count, since isdigit() alone also says yes to things like "²" which int() can't convert, and
+# fractional seconds have to be 1 to 6 digits, the same as strptime()'s "%f".
+
+	try:
+		if timeString.endswith( 'Z' ):
+			zoneStart = len( timeString ) - 1
+		elif timeString.endswith( '+00:00' ):
+			zoneStart = len( timeString ) - 6
+		else:
+			return None
+
+		if ( timeString[ 4 ] != '-' or timeString[ 7 ] != '-' or timeString[ 10 ] != 'T' or
+		     timeString[ 13 ] != ':' or timeString[ 16 ] != ':' ):
+			return None
+
+		# Anything between the seconds and the time zone has to be fractional seconds
+		if zoneStart != 19:
+			fraction = timeString[ 20:zoneStart ]
+			if not ( timeString[ 19 ] == '.' and 1 <= len( fraction ) <= 6 and fraction.isascii() and fraction.isdigit() ):
+				return None
+
+		fields = ( timeString[ 0:4 ], timeString[ 5:7 ], timeString[ 8:10 ], timeString[ 11:13 ], timeString[ 14:16 ], timeString[ 17:19 ] )
+		if not all( field.isascii() and field.isdigit() for field in fields ):
+			return None
+		year, month, day, hour, minute, second = [ int( field ) for field in fields ]
+	except ( AttributeError, IndexError, ValueError ):		# Not a string, too short, or not a number after all
+		return None
+
+	if not ( year >= 1 and 1 <= month <= 12 and hour <= 23 and minute <= 59 and second <= 59 ):
+		return None		# Let strptime() have a go, and complain about it
+	if not 1 <= day <= calendar.monthrange( year, month )[ 1 ]:
+		return None		# Such as Feb 31 - timegm() would just roll it over into March
+
+	return calendar.timegm( ( year, month, day, hour, minute, second, 0, 0, 0 ) )
+
+
+
+###################################################################################################
+class CachedResponse( object ):
+
+# This stands in for the HTTPResponse from HTTPSConnection.getresponse() when send_request()
+# returns a response which has already been read and parsed - either from the cache file, or because
+# it had to be parsed to be saved into the cache file. 'data' is the parsed JSON. See read_result()
+
+	status = 200
+
+	def __init__( self, data ):
+		self.data = data
+
+
+
+###################################################################################################
+def open_cache_file():
+
+# Open (and create if needed) the cache file for this account.
+# 
+# Usage: open_cache_file()
+# 
+# Returns: file object, or None if there's any problem with it
+# 
+# Note: The file is only readable by us since it has account details in it, and because it
+# lives in a shared directory we refuse to use one which belongs to anybody else.
+
+	try:
+		path = CACHE_FILE.format( hashlib.sha1( args.username.encode( 'utf-8' ) ).hexdigest() )
+		fd = os.open( path, os.O_RDWR | os.O_CREAT | getattr( os, 'O_NOFOLLOW', 0 ), 0o600 )
+		if os.fstat( fd ).st_uid != os.getuid():
+			os.close( fd )
+			return None
+		return os.fdopen( fd, 'r+' )
+	except Exception:
+		return None
+
+
+
+###################################################################################################
+def read_cache( function, params ):
+
+# Look for a saved response from an earlier run which is still fresh enough to use.
+# 
+# Usage: read_cache( string, dict )
+# 	'string' is the API function call
+# 	'dict' is a dictionary of parameters for the API call
+# 
+# Returns: the parsed JSON response, or None if there isn't a usable one
+# 
+# Note: Any problem with the cache just means a cache miss. It must never break the check!
+
+	cacheFile = open_cache_file()
+	if cacheFile is None: return None
+	try:
+		fcntl.flock( cacheFile, fcntl.LOCK_SH )		# Wait for anybody who is writing it
+		entry = json_loads( cacheFile.read() or "{}" ).get( function + json.dumps( params, sort_keys = True ) )
+		if entry and 0 <= time.time() - entry[ 'time' ] < CACHE_TTL[ function ]:
+			return entry[ 'data' ]
+	except Exception:
+		pass
+	finally:
+		cacheFile.close()		# This also releases the lock
+	return None
+
+
+
+###################################################################################################
+def write_cache( function, params, data ):
+
+# Save a response in the cache file for the following runs to use. See read_cache()
+# 
+# Usage: write_cache( string, dict1, dict2 )
 # 	'string' is the API function call
 # 	'dict1' is a dictionary of parameters for the API call
-# 	'dict2' is a dictionary of HTTP headers - currently only used for the session auth cookie
+# 	'dict2' is the parsed JSON response
+# 
+# Note: The response goes in as JSON inside the cache file's JSON, rather than as a string of
+# the response body, so that reading the cache back only needs one JSON parse.
+# 
+# Returns: nothing
+
+	cacheFile = open_cache_file()
+	if cacheFile is None: return
+	try:
+		fcntl.flock( cacheFile, fcntl.LOCK_EX )		# Only one writer at a time, so we don't lose each other's entries
+		try:
+			cache = json_loads( cacheFile.read() or "{}" )
+		except ValueError:
+			cache = {}		# Start again if it's been mangled somehow
+
+		# Take the chance to throw out anything which is too old to be used again
+		now = time.time()
+		for key in list( cache ):		# A copy of the keys, since we're deleting as we go
+			if now - cache[ key ][ 'time' ] >= CACHE_TTL.get( cache[ key ][ 'function' ], 0 ):
+				del cache[ key ]
+		cache[ function + json.dumps( params, sort_keys = True ) ] = { 'function': function, 'time': now, 'data': data }
+
+		cacheFile.seek( 0 )
+		cacheFile.truncate()
+		cacheFile.write( json.dumps( cache ) )
+	except Exception:
+		pass
+	finally:
+		cacheFile.close()
+
+
+
+###################################################################################################
+def open_connection():
+
+# Set up the one HTTPS connection which will be re-used (keep-alive) for all the API calls.
+# This is only done when send_request() first needs it - if everything comes from the cache
+# we don't need to connect at all.
 # 
-# Returns: tuple of HTTPSConnection.getresponse(), and the connection object itself (to allow closing outside this function)
+# Usage: open_connection()
+# 
+# Returns: nothing - sets the global 'connection'
+
+	global connection
+	import http.client, socket
 
-	connection = httplib.HTTPSConnection( CLOUDENDURE_API_HOST, 443 )
+	connection = http.client.HTTPSConnection( CLOUDENDURE_API_HOST, 443, timeout=10 )
 	try:
 		connection.connect()
-	except HTTPException:
-		exit_with_message( "Problem setting up the HTTPS connection to \"" + CLOUDENDURE_API_HOST + "\" !!", EXIT_STATUS_DICT[ 'UNKNOWN' ] )
-	headers.update( { 'Content-Type': 'application/json' } )
+	except Exception:
+		exit_with_message( "Problem setting up the HTTPS connection to \"" + CLOUDENDURE_API_HOST + "\" !!", UNKNOWN )
+
+	# Our requests are small JSON POSTs, so send them right away instead of letting Nagle's
+	# algorithm hold them back waiting for more data. Also turn on TCP keep-alive probes so
+	# any firewall / NAT in the way doesn't drop the connection while it's idle.
+	# (The keep-alive timing options are Linux-only, so only set those where they exist.)
+	try:
+		connection.sock.setsockopt( socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 )
+		connection.sock.setsockopt( socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1 )
+		if hasattr( socket, 'TCP_KEEPIDLE' ):  connection.sock.setsockopt( socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60 )
+		if hasattr( socket, 'TCP_KEEPINTVL' ): connection.sock.setsockopt( socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 30 )
+	except Exception:
+		pass		# These are just tuning - carry on without them
+
+
+
+###################################################################################################
+def log_in():
+
+# Do the login. This is where send_request() picks up the session cookie.
+# This is only done when send_request() first has to make a real API call - see the note there.
+# 
+# Usage: log_in()
+# 
+# Returns: nothing - will exit UNKNOWN if it doesn't work
+
+	try:
+		response = send_request( 'login', { 'username': args.username, 'password': args.password } )
+		response.read()		# Drain the body so the connection can be re-used
+	except Exception:
+		exit_with_message( "Could not get a response on the login transaction!", UNKNOWN )
+
+	if not session_cookie:
+		exit_with_message( "Could not get a session cookie from the login transaction!", UNKNOWN )
+
+
+
+###################################################################################################
+def send_request( function, params, exitOnError = True, useCache = True ):
+
+# This function makes the HTTPS call out to the CloudEndure API and makes sure we get a '200' HTTP status
+# before returning the JSON
+# 
+# Usage: send_request( string, dict [, bool1 [, bool2 ] ] )
+# 	'string' is the API function call
+# 	'dict' is a dictionary of parameters for the API call
+# 	'bool1' is optional - if False, a non-200 response is returned (already read) instead of exiting UNKNOWN
+# 	'bool2' is optional - if False, always make the API call even if there's a cached response (which gets replaced)
+# 
+# Returns: HTTPSConnection.getresponse() (or a CachedResponse standing in for it)
+# 
+# Note: All the API calls share the one keep-alive 'connection' which is set up by open_connection()
+# the first time it's needed, so we only pay for the TCP + TLS handshake once per run instead of once
+# per call. It stays open until the logout in exit_with_message().
+# Because of that, every caller MUST read() the whole response before the next send_request()
+# otherwise http.client won't let the connection be used again.
+# 
+# Note: This also looks after the session auth cookie, like a browser's cookie jar would. Whatever
+# 'session' cookie the API hands back (from 'login') is kept in 'session_cookie' and sent with
+# every call after that, so the callers don't have to deal with it.
+# 
+# Note: Responses for the functions in CACHE_TTL come from the cache file if a recent enough one is
+# there. We only connect and log in when we actually have to make an API call, so a run which
+# gets everything from the cache doesn't talk to CloudEndure at all.
+
+	global session_cookie
+
+	if function in CACHE_TTL and useCache:
+		data = read_cache( function, params )
+		if data is not None:
+			if args.verbose: print( "\nUsing the cached {0} response".format( function ) )
+			return CachedResponse( data )
+
+	if connection is None: open_connection()
+	if function != 'login' and not session_cookie: log_in()
+
+	headers = { 'Content-Type': 'application/json', 'Connection': 'keep-alive', 'Accept-Encoding': 'gzip' }	# JSON squashes really well, see read_body()
+	if session_cookie: headers[ 'Cookie' ] = session_cookie
 
 	# For debugging it's helpful to include the 'params' in verbose output, but
 	# that exposes the password when calling the 'login' API function - so it's not
 	# a great idea. Instead just show the function name and headers. That's safe.
-	## if args.verbose: print "\nCalling {0} with {1} and {2}".format( function, params, headers )
-	if args.verbose: print "\nCalling {0} with {1}".format( function, headers )
+	## if args.verbose: print( "\nCalling {0} with {1} and {2}".format( function, params, headers ) )
+	if args.verbose: print( "\nCalling {0} with {1}".format( function, headers ) )
 
 	connection.request( 'POST', '/latest/' + function, json.dumps( params ), headers )
 	connectionResponse = connection.getresponse()
 
 	if connectionResponse.status != 200:
-		exit_with_message( "{0} call returned HTTP code {1} {2}".format( function, connectionResponse.status, connectionResponse.reason ), EXIT_STATUS_DICT[ 'UNKNOWN' ] )
-	return connectionResponse, connection
+		if not exitOnError:
+			connectionResponse.read()	# The caller will deal with it. Drain it so the connection can be re-used.
+			return connectionResponse
+		connection.close()	# Don't leave the shared connection half-way through a response we won't read
+		exit_with_message( "{0} call returned HTTP code {1} {2}".format( function, connectionResponse.status, connectionResponse.reason ), UNKNOWN )
+
+	# If we were handed a session cookie, keep it for the following calls. Each set-cookie header
+	# gets parsed on its own, so the commas in something like "expires=Wed, 21 Oct ..." don't confuse it.
+	# We only send back the "session=value" part, not the attributes such as path and expires.
+	for setCookie in connectionResponse.msg.get_all( 'set-cookie' ) or []:
+		cookies = SimpleCookie()
+		try:
+			cookies.load( setCookie )
+		except Exception:
+			continue		# Not one we can make sense of, and it can't be the one we want
+		if 'session' in cookies: session_cookie = cookies[ 'session' ].OutputString( attrs = [] )
+
+	if function in CACHE_TTL:
+		try:
+			data = json_loads( read_body( connectionResponse ) )
+		except Exception:
+			data = None		# Bad JSON or bad gzip - let read_result() complain about it
+		if isinstance( data, dict ) and 'result' in data: write_cache( function, params, data )	# Don't save a bad one for next time
+		return CachedResponse( data )
+
+	return connectionResponse
+
+
+
+###################################################################################################
+def get_location( useCache = True ):
+
+# Find out the location of the replicas, from the user info.
+# 
+# Usage: get_location( [ bool ] )
+# 	'bool' is optional - if False, don't use a cached getUserDetails response
+# 
+# Returns: string of the location - will exit UNKNOWN if we can't get it
+
+	response = send_request( 'getUserDetails', {}, True, useCache )
+	result = read_result( response, 'getUserDetails' )
+
+	if args.verbose: print( "\ngetUserDetails:", json.dumps( result, indent = 2 ) )
+
+	try:
+		return result[ 'originalLocation' ]
+	except Exception:
+		exit_with_message( "Could not get a value for \"originalLocation\" from the \"getUserDetails\" transaction!", UNKNOWN )
+
+
+
+###################################################################################################
+def read_body( response ):
+
+# Read the whole body of an API response, un-compressing it if it came gzipped.
+# (send_request() asks for gzip since a big listMachines response is a lot smaller that way.)
+# 
+# Usage: read_body( response )
+# 	'response' is an HTTPResponse from send_request()
+# 
+# Returns: bytes of the body - raises an exception if it says it's gzipped but it isn't
+
+	body = response.read()
+	if ( response.getheader( 'content-encoding' ) or "" ).lower() == 'gzip':
+		import gzip
+		body = gzip.decompress( body )
+	return body
+
+
+
+###################################################################################################
+def read_result( response, function ):
+
+# Get the "result" object out of an API response, which is the only part of it we ever need.
+# 
+# Usage: read_result( response, string )
+# 	'response' is what send_request() returned
+# 	'string' is the API function call, for the error message
+# 
+# Returns: the "result" object from the JSON - will exit UNKNOWN if there isn't one
+# 
+# Note: Responses which send_request() has already parsed (see CachedResponse) don't get parsed again.
+
+	try:
+		if isinstance( response, CachedResponse ):
+			return response.data[ 'result' ]
+		return json_loads( read_body( response ) )[ 'result' ]
+	except Exception:
+		exit_with_message( "Could not get a \"result\" object from the \"{0}\" transaction!".format( function ), UNKNOWN )
 
 
 
@@ -278,18 +666,16 @@ def seconds_to_time_text( inputSeconds ):
 
 	results = []
 	periods = (
-		( "days",    86400 ),
-		( "hours",   3600 ),
-		( "minutes", 60 ),
-		( "seconds", 1 )
+		( "day",    "days",    86400 ),
+		( "hour",   "hours",   3600 ),
+		( "minute", "minutes", 60 ),
+		( "second", "seconds", 1 )
 	)
 
-	for interval, number in periods:
-		timePart = inputSeconds // number		# Modulus / floor divide
+	for singular, plural, number in periods:
+		timePart, inputSeconds = divmod( inputSeconds, number )		# Floor divide, and keep the remainder for the next period
 		if timePart:
-			inputSeconds -= timePart * number	# Take away the part so far
-			if timePart == 1: interval = interval.rstrip( "s" )	# Handle singular case
-			results.append( "{0} {1}".format( timePart, interval ) )
+			results.append( "{0} {1}".format( timePart, singular if timePart == 1 else plural ) )
 	output = ", ".join( results )
 	return output + trailingText
 
@@ -308,65 +694,63 @@ parser.add_argument( "-n", "--hostname", help = "hostname of instance to check,
 args = parser.parse_args()
 
 if args.verbose:
-	print "Time now", int( time.time() )
-	print "username", args.username
-# 	print "password", args.password		# Echoing the password is probably not a good idea, but it comes in on the command line anyway.
-	print "hostname", args.hostname
+	print( "Time now", NOW )
+	print( "username", args.username )
+# 	print( "password", args.password )		# Echoing the password is probably not a good idea, but it comes in on the command line anyway.
+	print( "hostname", args.hostname )
 
 
-# Do the login
-try:
-	response, connection = send_request( 'login', { 'username': args.username, 'password': args.password }, {} )
-except Exception:
-	exit_with_message( "Could not get a response on the login transaction!", EXIT_STATUS_DICT[ 'UNKNOWN' ] )
+# The connection and the login are both done by send_request() when it first needs them.
+connection = None
+session_cookie = ""		# Set it to null in case we get all the way to the 'logout' call - we at least need it initialized.
 
 
-# Extract the session cookie from the login
-try:
-	session_cookie = [ header[ 1 ] for header in response.getheaders() if header[ 0 ] == 'set-cookie' ][ 0 ]
-	connection.close()
-	if args.verbose: print "Connection closed"
-except Exception:
-	session_cookie = ""		# Set it to null in case we get all the way to the 'logout' call - we at least need it initialized.
-	exit_with_message( "Could not get a session cookie from the login transaction!", EXIT_STATUS_DICT[ 'UNKNOWN' ] )
-cookies = re.split( '; |, ', session_cookie )
-session_cookie = [ cookie for cookie in cookies if cookie.startswith( 'session' ) ][ 0 ].strip()
-
-
-# Get the replica location from the user info
-response, connection = send_request( 'getUserDetails', {}, { 'Cookie': session_cookie } )
-try:
-	result = json.loads( response.read() )[ 'result' ]
-	connection.close()
-	if args.verbose: print "Connection closed"
-except Exception:
-	exit_with_message( "Could not get a \"result\" object from the \"getUserDetails\" transaction!", EXIT_STATUS_DICT[ 'UNKNOWN' ] )
-
-if args.verbose: print "\ngetUserDetails:", json.dumps( result, sort_keys = True, indent = 4 )
-
-try:
-	location = result[ 'originalLocation' ]
-except Exception:
-	exit_with_message( "Could not get a value for \"originalLocation\" from the \"getUserDetails\" transaction!", EXIT_STATUS_DICT[ 'UNKNOWN' ] )
+# Get the replica location from the user info. Most of the time this comes from the cache.
+location = get_location()
 
 
 # This is from some sample code I incorporated into this script. Since the 'for' loop
 # looks useful for future things, I'm including it here for reference. This builds and prints
 # a one-line comma-separated list of machine IDs. This is not needed in this script.
-# response, connection = send_request( 'listMachines', { 'location': location }, { 'Cookie': session_cookie } )
-# machineIds = [ machine[ 'id' ] for machine in json.loads( response.read() )[ 'result' ] ]
-# print ', '.join(machineIds)
+# response = send_request( 'listMachines', { 'location': location } )
+# machineIds = [ machine[ 'id' ] for machine in read_result( response, 'listMachines' ) ]
+# print( ', '.join(machineIds) )
 
 
 # Now that we have the location, we list all machines. This gets us all info about everything!
-response, connection = send_request( 'listMachines', { 'location': location }, { 'Cookie': session_cookie } )
-try:
-	instances = json.loads( response.read() )[ 'result' ]
-	connection.close()
-	if args.verbose: print "Connection closed"
-except Exception:
-	exit_with_message( "Could not get a \"result\" object from the \"listMachines\" transaction!", EXIT_STATUS_DICT[ 'UNKNOWN' ] )
-if args.verbose: print "\nlistMachines:", json.dumps( instances, sort_keys = True, indent = 4 )
+# If we only want one host, and there isn't a full list in the cache we can look it up in, first
+# try asking the API for just that one by name, so it doesn't have to send (and we don't have to
+# parse) the whole account. If the API doesn't accept the 'name' we use the full list - and make
+# a note of that in the cache file, so for the next day we go straight to the full list instead
+# of asking by name first.
+# Note: What comes back when we ask by name is only ever used to find that one host. We can't
+# be sure how the API matches the name (exactly, by prefix, ignoring case...) so it might be any
+# part of the account - it must never be saved or used as the full list, or an "all" check could
+# miss hosts which are in trouble.
+response = None
+nameRejected = False
+if args.hostname != "all":
+	data = read_cache( 'listMachines', { 'location': location } )
+	if data is not None:
+		if args.verbose: print( "\nUsing the cached listMachines response" )
+		response = CachedResponse( data )
+	elif read_cache( 'noNameFilter', {} ) is None:
+		response = send_request( 'listMachines', { 'location': location, 'name': args.hostname }, False )
+		if response.status != 200:
+			if args.verbose: print( "listMachines with a name returned HTTP code {0} - getting the full list instead".format( response.status ) )
+			nameRejected = True		# Only noted once the full list works, in case it was the location which was wrong
+			response = None
+if response is None:
+	response = send_request( 'listMachines', { 'location': location }, False )
+	if response.status != 200:
+		# Maybe the location has changed since we cached it, so get it fresh and try one more time
+		if args.verbose: print( "listMachines returned HTTP code {0} - getting the location again".format( response.status ) )
+		location = get_location( False )
+		response = send_request( 'listMachines', { 'location': location } )
+	elif nameRejected:
+		write_cache( 'noNameFilter', {}, True )
+instances = read_result( response, 'listMachines' )
+if args.verbose: print( "\nlistMachines:", json.dumps( instances, indent = 2 ) )
 
 
 
@@ -377,9 +761,9 @@ if args.verbose: print "\nlistMachines:", json.dumps( instances, sort_keys = Tru
 # 
 # for x in instances:
 # 	timetest = "2016-01-01T22:08:15.803212+00:00"
-# 	print "\n*** Setting lastConsistencyTime to " + timetest + " for testing"
+# 	print( "\n*** Setting lastConsistencyTime to " + timetest + " for testing" )
 # 	x[ 'lastConsistencyTime' ] = timetest
-# 	print "\n*** Setting replicationState to \"foo\" for testing"
+# 	print( "\n*** Setting replicationState to \"foo\" for testing" )
 # 	x[ 'replicationState' ] = "foo"
 ################################################################
 
@@ -387,72 +771,52 @@ if args.verbose: print "\nlistMachines:", json.dumps( instances, sort_keys = Tru
 
 if args.hostname == "all":		# "all" means we're going to check all of them (duh)
 
-	summaryMessage = ""		# Init to null because we are going to be appending text
 	highestError = 0		# Track the worst status for the final return code
-	statusDict = {}			# Init a dictionary to track all the instances' status for later use
+	statusDict = defaultdict( list )	# Each severity level will hold names of instances - an empty list until it gets one
 
-	for severity in ( EXIT_STATUS_DICT[ 'OK' ], EXIT_STATUS_DICT[ 'WARNING' ], EXIT_STATUS_DICT[ 'CRITICAL' ], EXIT_STATUS_DICT[ 'UNKNOWN' ] ):
-		statusDict[ severity ] = []		# Initialize the structure - each severity level will hold names of instances
-
-	for instance in instances:
-		if args.verbose: print "\nname:", instance[ 'name' ]
+	# Each instance can be checked independently of the others, so run them in a pool of threads.
+	# The pool is capped at MAX_CHECK_THREADS so that a big account doesn't get a thread per host.
+	if len( instances ) < 2:
+		results = list( map( last_sync_time_test, instances ) )
+	else:
+		from concurrent.futures import ThreadPoolExecutor
+		with ThreadPoolExecutor( max_workers = min( MAX_CHECK_THREADS, len( instances ) ) ) as pool:
+			results = list( pool.map( last_sync_time_test, instances ) )		# This is the heart of the analysis of health.
 
-		message, exitCode = last_sync_time_test( instance )		# This is the heart of the analysis of health.
-		statusDict[ instance[ 'name' ] ] = {}				# Init the structure for each host
-		statusDict[ instance[ 'name' ] ][ 'message' ] = message		# Store the message for each host
-		statusDict[ instance[ 'name' ] ][ 'exitCode' ] = exitCode	# Store the status code for each host
+	for instance, ( message, exitCode ) in zip( instances, results ):
+		verbose_print( "\n{0}: {1}".format( SEVERITY_NAMES[ exitCode ], message ) )	# Only the summary uses the results, so the messages just get shown here
 		statusDict[ exitCode ].append( instance[ 'name' ] )		# Push the name of this instance into the array for its severity
-		statusDict[ exitCode ].sort
+		highestError = max( highestError, exitCode )		# Capture the "worst" error state
 
-		if args.verbose: print "\nstatusDict:", json.dumps( statusDict, sort_keys = True, indent = 4 )
-		if exitCode > highestError: highestError = exitCode	# Capture the "worst" error state
+	if args.verbose: print( "\nstatusDict:", json.dumps( statusDict, indent = 2 ) )	# Once, after it's complete - not every time around the loop
 
-	# Now we build up the 'summaryMessage' by iterating across all the different statuses. (or stati? My Latin sucks.)
+	# Now we build up the summary message from all the different statuses. (or stati? My Latin sucks.)
 	# For each level of severity we'll build a comma-separated list of hostnames with that status.
 	# If a severity level doesn't have any hosts in that state, we'll output '0' (zero).
 	# Each of the severity levels will be slash-separated.
 	# Example:
 	# OK: server12.blah.com / WARNING: 0 / CRITICAL: server1.blah.com, server8.blah.com / UNKNOWN: 0
-	for severity in ( EXIT_STATUS_DICT[ 'OK' ], EXIT_STATUS_DICT[ 'WARNING' ], EXIT_STATUS_DICT[ 'CRITICAL' ], EXIT_STATUS_DICT[ 'UNKNOWN' ] ):
-
-		wasPreviousCountZero = True			# Track what the previous number was, so we know when to use a slash vs. comma
-		if len( statusDict[ severity ] ) > 0:		# Is there one or more host(s) with this severity level?
-			isFirstHostName = True
-			for name in statusDict[ severity ]:	# If there are hosts this time, add each one to the summary message by iterating over the list
-				if len( summaryMessage ) > 0:	# Only add punctuation if we're not starting off for the very first time
-					if wasPreviousCountZero == True:
-						summaryMessage += " / "
-					else:
-						summaryMessage += ", "
-				if isFirstHostName: 		# Only add the name of the severity level if it's the first host with this level
-					summaryMessage += EXIT_STATUS_DICT_REVERSE[ severity ] + ": "
-					isFirstHostName = False
-				summaryMessage += name
-				wasPreviousCountZero = False
-
-		else:						# If there wasn't any host in this severity, show zero
-			if len( summaryMessage ) > 0: 		# Don't add a comma if we're just starting off for the first round
-				summaryMessage += " / "
-			summaryMessage += EXIT_STATUS_DICT_REVERSE[ severity ] + ": 0"
-			wasPreviousCountZero = True
-
-	summaryMessage = "Status of all hosts in account \"" + args.username + "\": " + summaryMessage
+	summaryParts = []
+	for severity in SEVERITIES:
+		names = statusDict[ severity ]
+		summaryParts.append( "{0}: {1}".format( SEVERITY_NAMES[ severity ], ", ".join( names ) if names else "0" ) )
+
+	summaryMessage = "Status of all hosts in account \"{0}\": {1}".format( args.username, " / ".join( summaryParts ) )
 	exit_with_message( summaryMessage, highestError )
 
 else:		# This means we were given a specific host name to check
-	foundTheHostname = False
-	for instance in instances:	# Here we are looking for one in particular out of all of them, so iterate
-		if instance[ 'name' ] == args.hostname:
-			foundTheHostname = True
-			if args.verbose: print "\nI found %s" % args.hostname
-			message, exitCode = last_sync_time_test( instance )
-			exit_with_message( message, exitCode )
+	# Here we are looking for one in particular out of all of them, so stop at the first match
+	instance = next( ( instance for instance in instances if instance[ 'name' ] == args.hostname ), None )
 
 	# Not finding the host name that was specified is a big problem!!!
-	if foundTheHostname == False: exit_with_message( "Could not find the specified hostname \"" + args.hostname
-							+ "\" in account \"" + args.username + "\" !!", EXIT_STATUS_DICT[ 'CRITICAL' ] )
+	if instance is None: exit_with_message( "Could not find the specified hostname \"" + args.hostname
+						+ "\" in account \"" + args.username + "\" !!", CRITICAL )
+
+	if args.verbose: print( "\nI found {0}".format( args.hostname ) )
+	message, exitCode = last_sync_time_test( instance )
+	exit_with_message( message, exitCode )
 
 
 # Bail out fail-safe (but in this case "safe" is to notify us of the problem!)
-exit_with_message( "Something went wrong - this should not happen.", EXIT_STATUS_DICT[ 'UNKNOWN' ] )
+exit_with_message( "Something went wrong - this should not happen.", UNKNOWN )
 
@@ -1,4 +1,4 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 
 # =================================================================================================
 # check_JSON_status_URL.py
@@ -20,26 +20,43 @@
 # also does _not_ match the string WARNSTRING (if given).
 # 
 # 
-# Usage: check_JSON_status_URL.py [-h] [-v] -u URL -p OKSTRING [-w WARNSTRING]
+# Usage: check_JSON_status_URL.py [-h] [-v] (-u URL | -b | -f URLS_FILE) -p
+#                                 OKSTRING [-w WARNSTRING] [--strict-url]
+#                                 [--fail-fast] [-4 | -6]
 # 
 # Nagios check of a JSON app health object. Exit status 0 == OK, 1 == Warning, 
 # 2 == Critical, 3 == Unknown.
 # 
 # optional arguments:
 #   -h, --help            show this help message and exit
-#   -v, --verbose         increase output verbosity
-#   -u URL, --url URL     URL to be checked - required
+#   -v, --verbose         increase output verbosity (the JSON is indented by 2
+#                         instead of 4 if orjson is installed)
+#   -u URL, --url URL     URL to be checked - required unless using --batch
+#   -b, --batch           read URLs to be checked from STDIN, one per line, and
+#                         print one status line for each
+#   -f URLS_FILE, --urls-file URLS_FILE
+#                         the same as --batch, but read the URLs from this file
 #   -p OKSTRING, --okString OKSTRING
 #                         text string which indicates OK - required
 #   -w WARNSTRING, --warnString WARNSTRING
 #                         text string which indicates Warning
+#   --strict-url          always split up the URL with the full URL parser
+#   --fail-fast           stop at the first Critical attribute and only report
+#                         that one
+#   -4, --ipv4            connect using IPv4 (the default)
+#   -6, --ipv6            connect using IPv6
 # 
 # 
-# Exit status: 0, 1, 2, 3 as standard Nagios status codes. See EXIT_STATUS_DICT for mapping.
+# Exit status: 0, 1, 2, 3 as standard Nagios status codes. See OK / WARNING / CRITICAL / UNKNOWN for mapping.
 # 
 # Note: If no WARNSTRING arg is given, the only non-OK state returned will be CRITICAL.
 # Program errors will return Nagios UNKNOWN.
 # 
+# Note: With --batch (or --urls-file), each URL gets a line of output starting with the URL,
+# and the exit status is the worst of all of them. Up to 16 URLs are checked at the same time.
+# Connections are kept open and re-used for URLs on the same server, so checking many URLs
+# on one server only connects to it once per thread.
+# 
 # 
 # 
 # 
@@ -90,27 +107,45 @@
 # =================================================================================================
 
 
-import argparse, time, sys, httplib, json, socket
-from urlparse import urlparse
+import argparse, time, sys, http.client, json, socket, os, fcntl, threading
+from urllib.parse import urlparse
+
+# Parsing the health JSON is the only real CPU work we do, so if there's a faster JSON parser
+# installed, use it for reading - otherwise the standard one is fine. (Both raise a ValueError
+# for bad JSON.) The verbose dump of the JSON uses it too, but orjson can only indent by 2 spaces
+# instead of 4 - that's fine for debug output.
+try:
+	import orjson
+	json_loads = orjson.loads
+	def json_dumps_pretty( data ):
+		return orjson.dumps( data, option = orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS ).decode()
+except ImportError:
+	json_loads = json.loads
+	def json_dumps_pretty( data ):
+		return json.dumps( data, sort_keys = True, indent = 4 )
+
+###################################################################################################
+# Exit status codes
+OK, WARNING, CRITICAL, UNKNOWN = 0, 1, 2, 3
+
+# All the exit status codes from best to worst, and the status string for each one (indexed by the code)
+SEVERITIES = ( OK, WARNING, CRITICAL, UNKNOWN )
+SEVERITY_NAMES = ( "OK", "WARNING", "CRITICAL", "UNKNOWN" )
+
 
 ###################################################################################################
-# Dictionary for exit status codes
-EXIT_STATUS_DICT = {
-	"OK": 0,
-	"WARNING": 1,
-	"CRITICAL": 2,
-	"UNKNOWN": 3
-}
+# Upper limit on how many URLs get checked at the same time in batch mode
+MAX_CHECK_THREADS = 16
+
+# The only characters JSON counts as white space between its tokens. See all_ok_names()
+JSON_WHITESPACE = " \t\n\r"
 
 
 ###################################################################################################
-# Dictionary for looking up the status string from the value
-EXIT_STATUS_DICT_REVERSE = {
-	0: "OK",
-	1: "WARNING",
-	2: "CRITICAL",
-	3: "UNKNOWN"
-}
+# Since we get run every few minutes for the same URL, the DNS lookup of the host name gets saved
+# in a cache file (one per user) and re-used for this many seconds.
+DNS_CACHE_TTL  = 60
+DNS_CACHE_FILE = "/var/tmp/check_JSON_status_URL_dns_{0}.json"	# {0} gets the user ID
 
 
 ###################################################################################################
@@ -124,7 +159,7 @@ def portmapping( scheme ):
 
 
 ###################################################################################################
-def exit_with_message( message = "Something not defined", exitCode = EXIT_STATUS_DICT[ 'UNKNOWN' ] ):
+def exit_with_message( message = "Something not defined", exitCode = UNKNOWN ):
 
 # Output a message and exit
 # 
@@ -137,172 +172,528 @@ def exit_with_message( message = "Something not defined", exitCode = EXIT_STATUS
 # Note the default values.
 
 	prefix = ""
-	if exitCode == EXIT_STATUS_DICT[ 'UNKNOWN' ]: prefix = "Error: "		# Add additional info at beginning
+	if exitCode == UNKNOWN: prefix = "Error: "		# Add additional info at beginning
 
-	print "{0}{1}".format( prefix, message )
+	print( "{0}{1}".format( prefix, message ) )
 
 	sys.exit( exitCode )
 
 
 
 ###################################################################################################
+def open_dns_cache_file():
 
+# Open (and create if needed) the DNS cache file.
+# 
+# Usage: open_dns_cache_file()
+# 
+# Returns: file object, or None if there's any problem with it
+# 
+# Note: Because it lives in a shared directory, we refuse to use one which belongs to anybody else.
+# Otherwise somebody could send our checks to the wrong server.
 
+	try:
+		fd = os.open( DNS_CACHE_FILE.format( os.getuid() ), os.O_RDWR | os.O_CREAT | getattr( os, 'O_NOFOLLOW', 0 ), 0o600 )
+		if os.fstat( fd ).st_uid != os.getuid():
+			os.close( fd )
+			return None
+		return os.fdopen( fd, 'r+' )
+	except Exception:
+		return None
 
-# Set up our inputs from the command line. This also handles the "-h" and error usage output for free!
-parser = argparse.ArgumentParser( description = "Nagios check of a JSON app health object. Exit status 0 == OK, 1 == Warning, 2 == Critical, 3 == Unknown.",
-				  epilog = "https://github.com/stefan-wuensch/Nagios-Checks" )
-parser.add_argument( "-v", "--verbose",  help = "increase output verbosity", action = "store_true" )
-parser.add_argument( "-u", "--url", help = "URL to be checked - required", required = True )
-parser.add_argument( "-p", "--okString", help = "text string which indicates OK - required",  required = True )
-parser.add_argument( "-w", "--warnString", help = "text string which indicates Warning" )
-args = parser.parse_args()
 
-if args.verbose:
-	print "Time now", int( time.time() )
-	print "url", args.url
-	print "okString", args.okString
-	print "warnString", args.warnString
+
+###################################################################################################
+def cached_lookup( hostname, port ):
+
+# Look up the IP address for a host name, using the DNS cache file if there's a recent enough
+# answer in it.
+# 
+# Usage: cached_lookup( string, int )
+# 	'string' is the host name
+# 	'int' is the port number
+# 
+# Returns: tuple of ( string, int ) of the IP address and the port, such as ( '10.1.2.3', 443 )
+# 	Raises socket.error (or socket.gaierror) if the name can't be looked up.
+# 
+# Note: By default this is an IPv4 address from socket.gethostbyname(), which only has to ask for
+# the A record. With "--ipv6" it's the first IPv6 address from socket.getaddrinfo() instead.
+# 
+# Note: Any problem with the cache just means a cache miss. It must never break the check!
+# Failed lookups are never saved.
+
+	family = "ipv6" if args.ipv6 else "ipv4"
+	key = "{0}:{1}/{2}".format( hostname, port, family )
+	cacheFile = open_dns_cache_file()
+	if cacheFile is not None:
+		try:
+			fcntl.flock( cacheFile, fcntl.LOCK_SH )		# Wait for anybody who is writing it
+			entry = json.loads( cacheFile.read() or "{}" ).get( key )
+			if entry and 0 <= time.time() - entry[ 'time' ] < DNS_CACHE_TTL:
+				return tuple( entry[ 'address' ] )
+		except Exception:
+			pass
+		finally:
+			cacheFile.close()		# This also releases the lock
+
+	if args.ipv6:
+		address = socket.getaddrinfo( hostname, port, socket.AF_INET6, socket.SOCK_STREAM )[ 0 ][ -1 ][ 0:2 ]	# Leave out the flow info and scope ID
+	else:
+		address = ( socket.gethostbyname( hostname ), port )
+
+	cacheFile = open_dns_cache_file()
+	if cacheFile is not None:
+		try:
+			fcntl.flock( cacheFile, fcntl.LOCK_EX )		# Only one writer at a time, so we don't lose each other's entries
+			try:
+				cache = json.loads( cacheFile.read() or "{}" )
+			except ValueError:
+				cache = {}		# Start again if it's been mangled somehow
+			now = time.time()
+			for oldKey in list( cache ):		# Take the chance to throw out anything which is too old to be used again
+				if now - cache[ oldKey ][ 'time' ] >= DNS_CACHE_TTL:
+					del cache[ oldKey ]
+			cache[ key ] = { 'time': now, 'address': address }
+			cacheFile.seek( 0 )
+			cacheFile.truncate()
+			cacheFile.write( json.dumps( cache ) )
+		except Exception:
+			pass
+		finally:
+			cacheFile.close()
+
+	return address
 
 
 
-# If the URL given doesn't have a proper method / scheme, add one. 
-# Otherwise the 'urlparse' gets all weird. Default to HTTP.
-if "http" in args.url:
-	url = args.url
-else:
-	url = "http://" + args.url
-if args.verbose: print "url " + url
+###################################################################################################
+def ssl_context():
 
+# Get the SSL context for the HTTPS connections. It's only set up the first time it's needed
+# (plain HTTP checks don't need it at all) and then shared, so the CA certificates only get
+# loaded once no matter how many HTTPS connections we make.
+# 
+# Usage: ssl_context()
+# 
+# Returns: ssl.SSLContext
 
-urlObject = urlparse( url )
-scheme = urlObject.scheme
-if args.verbose: print "scheme " + scheme
+	global sslContext
+	with connectionsLock:		# Only one thread gets to set it up
+		if sslContext is None:
+			import ssl
+			sslContext = ssl.create_default_context()
+	return sslContext
 
-# If there's a port number given in the URL (like server:8080) then use that.
-# Otherwise look up the port in our dict.
-if urlObject.port:
-	port = urlObject.port
-else:
-	port = portmapping( scheme )
-if args.verbose: print "port: ", port, " hostname: ", urlObject.hostname
 
-# exit_with_message( "Debugging - bail out early.", EXIT_STATUS_DICT[ 'UNKNOWN' ] )	# For testing
 
+###################################################################################################
+class AddressHTTPSConnection( http.client.HTTPSConnection ):
 
-# Now do the connection setup
-# First look up the IP address from the hostname
-try:
-	ip, port = socket.getaddrinfo( urlObject.hostname, port )[ 0 ][ -1 ]
-except Exception:
-	exit_with_message( "Problem performing DNS name lookup on " + urlObject.hostname, EXIT_STATUS_DICT[ 'UNKNOWN' ] )
-if args.verbose: print "ip: ", ip
-if scheme == "http":
-	connection = httplib.HTTPConnection( ip, port, timeout=10 )
-else:
-	connection = httplib.HTTPSConnection( urlObject.hostname, port, timeout=10 )
-# Note: in the above connection setup, apparently the 'timeout' behavior is not optimal if you
-# use the hostname - because the name resolution can make the timeout wonky.
-# Instead, it's preferred to use the IP address in the connection setup (as the first arg)
-# but the SSL negotiation appears to fail without using the hostname - which makes sense.
+# An HTTPSConnection which connects to the IP address we already looked up (see cached_lookup())
+# instead of looking up the host name all over again. The host name is still used for the SSL
+# certificate check (SNI) and the Host header, so everything apart from the lookup is the same.
 
+	def __init__( self, hostname, address, **kwargs ):
+		http.client.HTTPSConnection.__init__( self, hostname, address[ 1 ], **kwargs )
+		self.address = address
 
-try:
-	connection.connect()
-except Exception:
-	exit_with_message( "Problem setting up the " + scheme + " connection to \"" + urlObject.hostname + ":" + str( port ) + "\" !!", EXIT_STATUS_DICT[ 'UNKNOWN' ] )
+	def connect( self ):
+		sock = socket.create_connection( self.address, self.timeout )
+		try:
+			sock.setsockopt( socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 )		# The same as HTTPConnection.connect() does
+			self.sock = ssl_context().wrap_socket( sock, server_hostname = self.host )
+		except Exception:
+			sock.close()
+			raise
 
 
-# If we needed to supply some parameters in JSON form, this is an example of how that would work:
-# connection.request( 'POST', '/some-form.cgi', json.dumps( params ), { 'Content-Type': 'application/json' } )
 
-connection.request( 'GET', urlObject.path )
-try:
-	connectionResponse = connection.getresponse()
-except Exception:
-	exit_with_message( "Problem performing getresponse() on connection - probably a timeout of the web service!", EXIT_STATUS_DICT[ 'CRITICAL' ] )
+###################################################################################################
+def open_connection( scheme, hostname, port ):
+
+# Look up the host and connect to it.
+# 
+# Usage: open_connection( string1, string2, int )
+# 	'string1' is the URL scheme - "http" or "https"
+# 	'string2' is the host name
+# 	'int' is the port number
+# 
+# Returns: tuple of ( connection, string ) - either an HTTPConnection / HTTPSConnection which is
+# 	connected, and None; or None and a string of what went wrong
+
+	# First look up the IP address from the hostname (most of the time it comes from the DNS cache file)
+	try:
+		ip, port = cached_lookup( hostname, port )
+	except Exception:
+		return ( None, "Problem performing DNS name lookup on " + hostname )
+	if args.verbose: print( "ip: ", ip )
+	if scheme == "http":
+		connection = http.client.HTTPConnection( ip, port, timeout=10 )
+	else:
+		connection = AddressHTTPSConnection( hostname, ( ip, port ), timeout=10, context = ssl_context() )
+	# Note: in the above connection setup, apparently the 'timeout' behavior is not optimal if you
+	# use the hostname - because the name resolution can make the timeout wonky.
+	# Instead, it's preferred to use the IP address in the connection setup (as the first arg)
+	# but the SSL negotiation fails without using the hostname - which makes sense. So for HTTPS
+	# we connect to the IP address, and give the hostname to the SSL setup. (This way "-4" / "-6"
+	# and the DNS cache work the same for HTTPS as for HTTP.)
 
-if connectionResponse.status != 200:
-	exit_with_message( "call returned HTTP code {0} {1}".format( connectionResponse.status, connectionResponse.reason ), EXIT_STATUS_DICT[ 'UNKNOWN' ] )
+	try:
+		connection.connect()
+	except Exception:
+		return ( None, "Problem setting up the " + scheme + " connection to \"" + hostname + ":" + str( port ) + "\" !!" )
 
-try:
-	appHealthJSON = json.loads( connectionResponse.read() )
-except Exception:
-	exit_with_message( "Could not get objects from the transaction!", EXIT_STATUS_DICT[ 'UNKNOWN' ] )
+	return ( connection, None )
+
+
+
+###################################################################################################
+def all_ok_names( body ):
+
+# Find out if the JSON is a simple object where every value is the OK string, without parsing it.
+# 
+# Usage: all_ok_names( string )
+# 	'string' is the raw body of the response
+# 
+# Returns: list of the names (keys) in the JSON if every value is exactly the OK string, or None
+# 	if it's anything else - in which case the caller has to parse it properly.
+# 
+# Note: With no backslashes there can't be any escaped quotes, so splitting on the quotes gives
+# us { / name / : / value / , / name / : / value / ... / } and we only have to check that every
+# piece is where it should be. Anything which doesn't fit that exactly gets None, which just means
+# doing it the slow way - so this can never give a different answer than the JSON parser would.
+# (That's why it only strips JSON's own white space, not everything str.strip() would, and why a
+# control character inside a name or value - which JSON doesn't allow - also gets None.)
+
+	okString = args.okString
+	if '"' in okString or '\\' in okString or min( okString, default = " " ) < " ": return None
+
+	try:
+		text = body.decode( 'utf-8' )
+	except Exception:
+		return None
+	if '\\' in text: return None
+
+	parts = text.split( '"' )
+	if len( parts ) % 4 != 1: return None
+	if parts[ 0 ].strip( JSON_WHITESPACE ) != "{" or parts[ -1 ].strip( JSON_WHITESPACE ) != "}": return None
+	if any( separator.strip( JSON_WHITESPACE ) != ":" for separator in parts[ 2::4 ] ): return None
+	if any( separator.strip( JSON_WHITESPACE ) != "," for separator in parts[ 4:-1:4 ] ): return None
+	if any( value != okString for value in parts[ 3::4 ] ): return None
+
+	names = parts[ 1::4 ]
+	if min( "".join( names ), default = " " ) < " ": return None
+	if len( set( names ) ) != len( names ): return None		# With a repeated name the JSON parser would only keep the last one
+	return names
+
+
+
+###################################################################################################
+def split_url( url ):
+
+# Split up a URL into the parts we need to fetch it.
+# 
+# Usage: split_url( string )
+# 	'string' is the URL, which has to start with "http://" or "https://"
+# 
+# Returns: tuple of ( string1, string2, int, string3 ) of the scheme, host name, port and path.
+# 	The port is None if the URL doesn't have one.
+# 
+# Note: Almost every URL we get is just scheme://host[:port]/path which can be split up a lot
+# quicker than urlparse() does it. So that's what we do, unless "--strict-url" was given or the
+# URL has anything in it which urlparse() would treat specially (a user name, query, fragment,
+# IPv6 address, escapes, non-ASCII, etc.) - then it goes to urlparse() so we get exactly the same
+# answer as always.
+
+	if not args.strict_url and url.isascii() and not any( character in url for character in "@?#;[]% \t\r\n" ):
+		scheme, _, rest = url.partition( "://" )
+		hostAndPort, slash, path = rest.partition( "/" )
+		host, colon, port = hostAndPort.rpartition( ":" )
+		if not colon:
+			host, port = hostAndPort, None
+		elif port.isdigit() and int( port ) <= 65535:
+			port = int( port )
+		else:
+			host = ""		# Not a port number we understand - let urlparse() deal with it
+		if host and ":" not in host:
+			return ( scheme, host.lower(), port, slash + path )
+
+	urlObject = urlparse( url )
+	return ( urlObject.scheme, urlObject.hostname, urlObject.port, urlObject.path )
+
+
+
+###################################################################################################
+def check_url( url ):
+
+# This function is the heart of the check - fetch the JSON from one URL and see how healthy it is.
+# 
+# Usage: check_url( string )
+# 	'string' is the URL to be checked
+# 
+# Returns: tuple of ( string, int ) where 'string' is the status message and 'int' is the status code
+# 
+# Note: Connections are kept open (keep-alive) in thread_connections(), so when we check several
+# URLs on the same server (see "--batch") we only connect to it once per thread.
+
+	# If the URL given doesn't have a proper method / scheme, add one. 
+	# Otherwise the 'urlparse' gets all weird. Default to HTTP.
+	# (Only look at the start of it, so that something like "my-http-server/health" gets one too.)
+	if not url.startswith( ( "http://", "https://" ) ):
+		url = "http://" + url
+	if args.verbose: print( "url " + url )
+
+	scheme, hostname, urlPort, path = split_url( url )
+	if args.verbose: print( "scheme " + scheme )
+	if not hostname: return ( "Could not find a host name in the URL!", UNKNOWN )
+
+	# If there's a port number given in the URL (like server:8080) then use that.
+	# Otherwise look up the port in our dict.
+	if urlPort:
+		port = urlPort
+	else:
+		port = portmapping( scheme )
+	if args.verbose: print( "port: ", port, " hostname: ", hostname )
+
+	# Now do the request, on a connection we already have to this server if there is one.
+	# A connection we kept open from an earlier URL might have been closed by the server since
+	# then. That's not a problem with this URL, so in that case connect again and have one more go.
+	connections = thread_connections()
+	connectionKey = ( scheme, hostname, port )
+	for attempt in ( 1, 2 ):
+		connection = connections.get( connectionKey )
+		reused = connection is not None
+		if not reused:
+			connection, message = open_connection( scheme, hostname, port )
+			if connection is None: return ( message, UNKNOWN )
+			connections[ connectionKey ] = connection
+
+		# If we needed to supply some parameters in JSON form, this is an example of how that would work:
+		# connection.request( 'POST', '/some-form.cgi', json.dumps( params ), { 'Content-Type': 'application/json' } )
+		try:
+			connection.request( 'GET', path, headers = { 'Connection': 'keep-alive' } )
+			connectionResponse = connection.getresponse()
+			break
+		except Exception as error:
+			connection.close()
+			del connections[ connectionKey ]
+			if reused and not isinstance( error, socket.timeout ): continue
+			return ( "Problem performing getresponse() on connection - probably a timeout of the web service!", CRITICAL )
+
+	# Every response has to be read all the way through, otherwise the connection can't be used again.
+	try:
+		body = connectionResponse.read()
+	except Exception:
+		connection.close()
+		del connections[ connectionKey ]
+		return ( "Could not get objects from the transaction!", UNKNOWN )
+
+	if connectionResponse.status != 200:
+		return ( "call returned HTTP code {0} {1}".format( connectionResponse.status, connectionResponse.reason ), UNKNOWN )
+
+	highestError = 0		# Track the worst status for the final return code (0 is no error, higher is worse)
+	statusDict = {}			# Init a dictionary to track all the instances' status for later use
+
+	for severity in SEVERITIES:
+		statusDict[ severity ] = []		# Initialize the structure - each severity level will hold names of instances
+
+	# Most of the time the service is healthy and every value is the OK string. all_ok_names() can
+	# spot that a lot quicker than parsing the JSON can, so try that first. (But not in verbose mode,
+	# because then we want to see everything.)
+	okNames = None
+	if not args.verbose: okNames = all_ok_names( body )
+
+	if okNames is not None:
+		statusDict[ OK ] = okNames
+
+	else:
+		try:
+			appHealthJSON = json_loads( body )
+		except Exception:
+			return ( "Could not get objects from the transaction!", UNKNOWN )
+
+		if args.verbose: print( "\nJSON:", json_dumps_pretty( appHealthJSON ), "\n" )
+
+		# Now we loop through everything we got back and populate the statusDict.
+		# Each value is looked up in 'statusForValue' - anything which isn't there is Critical.
+		# (The lookup, the verbose flag and the list appends are fetched once here, rather than every
+		# time around the loop. 'appendTo' is indexed by the severity, the same as SEVERITY_NAMES.)
+		statusOf, verbose, failFast = statusForValue.get, args.verbose, args.fail_fast
+		appendTo = tuple( statusDict[ severity ].append for severity in SEVERITIES )
+		for healthCheck, value in appHealthJSON.items():
+			if verbose: print( healthCheck, " is ", value )
+
+			try:
+				severity = statusOf( value, CRITICAL )
+			except TypeError:
+				severity = CRITICAL		# A list or object in the JSON can't be a dict key - and can't match either string anyway
+
+			# Nothing after a Critical can make the status any better, so if all we've been asked for
+			# is pass / fail, stop right here.
+			if failFast and severity == CRITICAL:
+				return ( "CRITICAL: {0} (stopped at the first Critical attribute because of --fail-fast)".format( healthCheck ), CRITICAL )
+
+			appendTo[ severity ]( healthCheck )
+			highestError = max( highestError, severity )		# Capture the "worst" state
+
+	# Note: We are not handling "UNKNOWN" but that's a future enhancement. For now we assume that only
+	# the status attributes found in the JSON are the ones to check. To-do: Add a JSON input parameter list
+	# which would contain all the expected attributes and anything not found would be 'UNKNOWN'.
+
+	if args.verbose: print( "\n", statusDict, "\n" )
+
+
+	# Now we build up the 'summaryMessage' from all the different statuses. (or stati? My Latin sucks.)
+	# For each level of severity we'll build a comma-separated list of attributes with that status.
+	# If a severity level doesn't have any attributes in that state, we'll output '0' (zero).
+	# Each of the severity levels will be slash-separated.
+	# Example:
+	# OK: Database Connection, Name Lookup / WARNING: 0 / CRITICAL: Auth Service / UNKNOWN: 0
+	summaryParts = []
+	for severity in SEVERITIES:
+		names = statusDict[ severity ]
+		summaryParts.append( "{0}: {1}".format( SEVERITY_NAMES[ severity ], ", ".join( names ) if names else "0" ) )
+
+	summaryMessage = "Status of all attributes: " + " / ".join( summaryParts )
+	return ( summaryMessage, highestError )
+
+
+
+###################################################################################################
+def safe_check_url( url ):
+
+# Run check_url() so that anything unexpected about one URL (such as "host:99999" where the port is
+# out of range, or no host name at all) turns into an Unknown for that URL. Otherwise a traceback
+# would kill the whole run - in batch mode all the other URLs would go unreported.
+# 
+# Usage: safe_check_url( string )
+# 	'string' is the URL to be checked
+# 
+# Returns: tuple of ( string, int ) just like check_url()
 
-connection.close()
-if args.verbose: print "Connection closed"
-if args.verbose: print "\nJSON:", json.dumps( appHealthJSON, sort_keys = True, indent = 4 ), "\n"
+	try:
+		return check_url( url )
+	except Exception as error:
+		return ( "Problem checking the URL - {0}: {1}".format( type( error ).__name__, error ), UNKNOWN )
 
 
 
-summaryMessage = ""		# Init to null because we are going to be appending text
-highestError = 0		# Track the worst status for the final return code (0 is no error, higher is worse)
-statusDict = {}			# Init a dictionary to track all the instances' status for later use
+###################################################################################################
+def thread_connections():
+
+# Get the connections which check_url() is keeping open for the thread we're in. A connection
+# can only do one request at a time, so each thread has its own.
+# 
+# Usage: thread_connections()
+# 
+# Returns: dictionary of connections, by ( scheme, hostname, port )
+
+	try:
+		return threadState.connections
+	except AttributeError:
+		threadState.connections = {}
+		with connectionsLock:
+			allConnections.append( threadState.connections )		# So that close_connections() can find them
+		return threadState.connections
+
+
+
+###################################################################################################
+def close_connections():
+
+# Close all the connections which check_url() kept open, in every thread.
+# 
+# Usage: close_connections()
+# 
+# Returns: nothing
+
+	with connectionsLock:
+		for connections in allConnections:
+			for connection in connections.values():
+				connection.close()
+			connections.clear()
+	if args.verbose: print( "Connection closed" )
+
 
-for severity in ( EXIT_STATUS_DICT[ 'OK' ], EXIT_STATUS_DICT[ 'WARNING' ], EXIT_STATUS_DICT[ 'CRITICAL' ], EXIT_STATUS_DICT[ 'UNKNOWN' ] ):
-	statusDict[ severity ] = []		# Initialize the structure - each severity level will hold names of instances
 
-# Now we loop through everything we got back and populate the statusDict
-for healthCheck in appHealthJSON:
-	if args.verbose: print healthCheck, " is ", appHealthJSON[ healthCheck ]
+###################################################################################################
+
 
-	if appHealthJSON[ healthCheck ] == args.okString:
-		statusDict[ healthCheck ] = EXIT_STATUS_DICT[ 'OK' ]
-		statusDict[ EXIT_STATUS_DICT[ 'OK' ] ].append( healthCheck )
 
-	elif appHealthJSON[ healthCheck ] == args.warnString:
-		statusDict[ healthCheck ] = EXIT_STATUS_DICT[ 'WARNING' ]
-		statusDict[ EXIT_STATUS_DICT[ 'WARNING' ] ].append( healthCheck )
-		if highestError == EXIT_STATUS_DICT[ 'OK' ]:	# Only track this Warning if there's not already been something worse - like Critical
-			highestError = EXIT_STATUS_DICT[ 'WARNING' ]
+# Set up our inputs from the command line. This also handles the "-h" and error usage output for free!
+parser = argparse.ArgumentParser( description = "Nagios check of a JSON app health object. Exit status 0 == OK, 1 == Warning, 2 == Critical, 3 == Unknown.",
+				  epilog = "https://github.com/stefan-wuensch/Nagios-Checks" )
+parser.add_argument( "-v", "--verbose",  help = "increase output verbosity (the JSON is indented by 2 instead of 4 if orjson is installed)", action = "store_true" )
+urlGroup = parser.add_mutually_exclusive_group( required = True )
+urlGroup.add_argument( "-u", "--url", help = "URL to be checked - required unless using --batch" )
+urlGroup.add_argument( "-b", "--batch", help = "read URLs to be checked from STDIN, one per line, and print one status line for each", action = "store_true" )
+urlGroup.add_argument( "-f", "--urls-file", help = "the same as --batch, but read the URLs from this file" )
+parser.add_argument( "-p", "--okString", help = "text string which indicates OK - required",  required = True )
+parser.add_argument( "-w", "--warnString", help = "text string which indicates Warning" )
+parser.add_argument( "--strict-url", help = "always split up the URL with the full URL parser", action = "store_true" )
+parser.add_argument( "--fail-fast", help = "stop at the first Critical attribute and only report that one", action = "store_true" )
+familyGroup = parser.add_mutually_exclusive_group()
+familyGroup.add_argument( "-4", "--ipv4", help = "connect using IPv4 (the default)", action = "store_true" )
+familyGroup.add_argument( "-6", "--ipv6", help = "connect using IPv6", action = "store_true" )
+args = parser.parse_args()
+
+if args.verbose:
+	print( "Time now", int( time.time() ) )
+	print( "url", args.url )
+	print( "batch", args.batch )
+	print( "okString", args.okString )
+	print( "warnString", args.warnString )
+
+
+# Connections we're keeping open - see thread_connections()
+threadState = threading.local()
+allConnections = []
+connectionsLock = threading.Lock()
+sslContext = None		# See ssl_context()
+
+# What each status string in the JSON means. Anything else is Critical.
+# (The OK one goes in last, so that if the two strings are the same, it's OK.)
+statusForValue = {}
+if args.warnString is not None: statusForValue[ args.warnString ] = WARNING
+statusForValue[ args.okString ] = OK
+
+
+if args.batch or args.urls_file:
+	if args.urls_file:
+		try:
+			with open( args.urls_file ) as urlsFile:
+				lines = urlsFile.readlines()
+		except Exception:
+			exit_with_message( "Could not read URLs from \"" + args.urls_file + "\" !!", UNKNOWN )
+	else:
+		lines = sys.stdin.readlines()
+	urls = [ line.strip() for line in lines if line.strip() and not line.strip().startswith( "#" ) ]	# Skip blank lines and comments
 
+	# Each URL can be checked independently of the others, so run them in a pool of threads.
+	# (In verbose mode just do them one at a time, otherwise the debugging output gets all jumbled up.)
+	if args.verbose or len( urls ) < 2:
+		results = list( map( safe_check_url, urls ) )
 	else:
-		statusDict[ healthCheck ] = EXIT_STATUS_DICT[ 'CRITICAL' ]
-		statusDict[ EXIT_STATUS_DICT[ 'CRITICAL' ] ].append( healthCheck )
-		highestError = EXIT_STATUS_DICT[ 'CRITICAL' ]
-
-# Note: We are not handling "UNKNOWN" but that's a future enhancement. For now we assume that only
-# the status attributes found in the JSON are the ones to check. To-do: Add a JSON input parameter list
-# which would contain all the expected attributes and anything not found would be 'UNKNOWN'.
-
-if args.verbose: print "\n", statusDict, "\n"
-
-
-# Now we build up the 'summaryMessage' by iterating across all the different statuses. (or stati? My Latin sucks.)
-# For each level of severity we'll build a comma-separated list of attributes with that status.
-# If a severity level doesn't have any attributes in that state, we'll output '0' (zero).
-# Each of the severity levels will be slash-separated.
-# Example:
-# OK: Database Connection, Name Lookup / WARNING: 0 / CRITICAL: Auth Service / UNKNOWN: 0
-for severity in ( EXIT_STATUS_DICT[ 'OK' ], EXIT_STATUS_DICT[ 'WARNING' ], EXIT_STATUS_DICT[ 'CRITICAL' ], EXIT_STATUS_DICT[ 'UNKNOWN' ] ):
-
-	wasPreviousCountZero = True			# Track what the previous number was, so we know when to use a slash vs. comma
-	if len( statusDict[ severity ] ) > 0:		# Is there one or more attributes(s) with this severity level?
-		isFirstAttrName = True
-		for name in statusDict[ severity ]:	# If there are attributes this time, add each one to the summary message by iterating over the list
-			if len( summaryMessage ) > 0:	# Only add punctuation if we're not starting off for the very first time
-				if wasPreviousCountZero == True:
-					summaryMessage += " / "
-				else:
-					summaryMessage += ", "
-			if isFirstAttrName: 		# Only add the name of the severity level if it's the first attribute with this level
-				summaryMessage += EXIT_STATUS_DICT_REVERSE[ severity ] + ": "
-				isFirstAttrName = False
-			summaryMessage += name
-			wasPreviousCountZero = False
-
-	else:						# If there wasn't any attribute in this severity, show zero
-		if len( summaryMessage ) > 0: 		# Don't add a comma if we're just starting off for the first round
-			summaryMessage += " / "
-		summaryMessage += EXIT_STATUS_DICT_REVERSE[ severity ] + ": 0"
-		wasPreviousCountZero = True
-
-summaryMessage = "Status of all attributes: " + summaryMessage
-exit_with_message( summaryMessage, highestError )
+		from concurrent.futures import ThreadPoolExecutor
+		with ThreadPoolExecutor( max_workers = min( MAX_CHECK_THREADS, len( urls ) ) ) as pool:
+			results = list( pool.map( safe_check_url, urls ) )
+	close_connections()
 
+	# Each URL gets its own line of output (in the order they were given), and we exit with
+	# the worst status of all of them.
+	highestError = OK
+	for url, ( message, exitCode ) in zip( urls, results ):
+		prefix = ""
+		if exitCode == UNKNOWN: prefix = "Error: "
+		print( "{0}: {1}{2}".format( url, prefix, message ) )
+		highestError = max( highestError, exitCode )
+	sys.exit( highestError )
+
+message, exitCode = safe_check_url( args.url )
+close_connections()
+exit_with_message( message, exitCode )
 
 
-# Bail out fail-safe (but in this case "safe" is to notify us of the problem!)
-exit_with_message( "Something went wrong - this should not happen.", EXIT_STATUS_DICT[ 'UNKNOWN' ] )
 
+# Bail out fail-safe (but in this case "safe" is to notify us of the problem!)
+exit_with_message( "Something went wrong - this should not happen.", UNKNOWN )